@@ -1,4 +1,23 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+
+def months_between(later, earlier):
+    """
+    Helper function to count the number of calendar months between
+    two series of dates
+
+    Args:
+        later (pd.Series): the later dates
+        earlier (pd.Series): the earlier dates, may contain NaT
+
+    Returns:
+        pd.Series: number of months, NaN where either date is missing
+    """
+    return ((later.dt.year - earlier.dt.year) * 12
+            + (later.dt.month - earlier.dt.month))
 
 
 class Pipe():
@@ -15,31 +34,43 @@ class Pipe():
             subscriptions_file (str): path to subscriptions csv
             bookings_file (str): path to bookings csv
         """
-        self.subscriptions_df = pd.read_csv(subscriptions_file)
-        self.bookings_df = pd.read_csv(bookings_file)
+        # read only the needed columns with the multithreaded pyarrow
+        # reader, parsing the statuses on the way in. The status
+        # categories are fixed so canceled can be filled in later even
+        # if the file has no canceled rows. The date columns are read as
+        # text: depending on their format pyarrow may already return
+        # timestamps, and parse_dates then fails on pandas 1.5
+        self.subscriptions_df = pd.read_csv(
+            subscriptions_file,
+            engine='pyarrow',
+            usecols=['sub_id', 'status', 'dates'],
+            dtype={'status': pd.CategoricalDtype(['active', 'canceled']),
+                   'dates': 'string'})
+        self.bookings_df = pd.read_csv(
+            bookings_file,
+            engine='pyarrow',
+            usecols=['subscriber_id', 'booking_status', 'booking_date'],
+            dtype={'booking_date': 'string'})
+
+        # change dates datatype
+        self.subscriptions_df['dates'] = pd.to_datetime(
+            self.subscriptions_df['dates'])
 
-        # drop unneeded columns
-        self.subscriptions_df.drop(columns=['Unnamed: 0'], inplace=True)
-        self.bookings_df.drop(columns='Unnamed: 0', inplace=True)
+        # store the ids as categoricals so the groupbys and comparisons
+        # work on small integer codes. This is done after reading since
+        # read_csv would parse the categories as strings and break the
+        # numeric sort order
+        self.subscriptions_df['sub_id'] = self.subscriptions_df[
+            'sub_id'].astype('category')
 
     def deduplicate_subscriptions(self):
         """
         Mark duplicated rows in subscriptions_df as invalid and then 
         drop the duplicates, keeping just one copy of the row
         """
-        # change dates datatype
-        self.subscriptions_df['dates'] = pd.to_datetime(
-            self.subscriptions_df['dates'])
-
-        # first find duplicate values
-        duplicated = self.subscriptions_df.duplicated(
+        # find the duplicate values and mark them as invalid
+        self.subscriptions_df['invalid_status'] = self.subscriptions_df.duplicated(
             subset=['dates', 'sub_id'], keep=False)
-        # mark the duplicates as invalid
-        self.subscriptions_df = pd.concat(
-            [self.subscriptions_df, duplicated], axis=1)
-        # give the new column an informative name
-        self.subscriptions_df.columns = [
-            'sub_id', 'status', 'dates', 'invalid_status']
         # drop the duplicate columns
         self.subscriptions_df.drop_duplicates(
             subset=['sub_id', 'dates'], inplace=True)
@@ -49,30 +80,41 @@ class Pipe():
         Fill in the missing months between dates per subscriber in subscriptions_df 
         """
         # Make a dataframe with min and max month per sub_id
-        # first get min date per sub_id
         dates = self.subscriptions_df.groupby(
-            'sub_id')['dates'].min().to_frame(name='min')
-        # get max date per group and concatenate to new dates df
-        max_dates = self.subscriptions_df.groupby(
-            'sub_id')['dates'].max().to_frame(name='max')
-        dates = dates.merge(max_dates, how='inner', on='sub_id')
+            'sub_id', observed=True)['dates'].agg(['min', 'max'])
+
+        # count the months in each subscriber's date range
+        min_months = dates['min'].values.astype('datetime64[M]')
+        max_months = dates['max'].values.astype('datetime64[M]')
+        n_months = (max_months - min_months).astype('int64') + 1
+
+        # repeat each sub_id and first month once per month in its range,
+        # then add the position of the month within the range
+        range_starts = np.repeat(np.cumsum(n_months) - n_months, n_months)
+        month_offsets = np.arange(n_months.sum()) - range_starts
+        all_months = np.repeat(min_months, n_months) + month_offsets
 
         # Create MultiIndex with date ranges per sub_id
-        midx = pd.MultiIndex.from_frame(
-            dates.apply(
-                lambda x: pd.date_range(x['min'], x['max'], freq='MS'), axis=1
-            ).explode().reset_index(name='dates')[['dates', 'sub_id']]
-        )
+        midx = pd.MultiIndex.from_arrays(
+            [all_months.astype('datetime64[ns]'),
+             dates.index.repeat(n_months)],
+            names=['dates', 'sub_id'])
 
         # flatten the index
         self.subscriptions_df = (
             self.subscriptions_df.set_index(['dates', 'sub_id'])
-            # use fill_value to mark the missing months as invalid
-                .reindex(midx, fill_value=True)
+                .reindex(midx)
                 .reset_index()
         )
+        # mark the missing months as invalid, their status is left
+        # empty since True is not one of the status categories
+        self.subscriptions_df['invalid_status'] = self.subscriptions_df[
+            'invalid_status'].fillna(True).astype(bool)
+
+        # sort once here, every later stage relies on the rows of each
+        # subscriber being consecutive and in date order
         self.subscriptions_df.sort_values(
-            by=['sub_id', 'dates']).to_csv('test1.csv')
+            by=['sub_id', 'dates'], inplace=True, ignore_index=True)
 
     def updated_statuses(self):
         """ 
@@ -82,55 +124,22 @@ class Pipe():
         is available, use the following valid status. If neither of 
         these exist, set the status to canceled
         """
-
-        def get_last_valid_status(row):
-            """
-            Helper function to find a valid status as defined above
-
-            Args:
-                row (pd.Series): a row of the subscription df
-
-            Returns:
-                str: 'active' or 'canceled'
-            """
-            if row['invalid_status']:
-                sub_id = row['sub_id']
-                month = row['dates']
-                prev_valid_status = self.subscriptions_df[
-                    (self.subscriptions_df['sub_id'] == sub_id)
-                    & (self.subscriptions_df['dates'] < month)
-                    & (self.subscriptions_df['invalid_status'] == False)
-                ].sort_values(by='dates')
-
-                # if there is no previous valid status check for next valid status
-                if len(prev_valid_status) == 0:
-                    next_valid_status = self.subscriptions_df[(self.subscriptions_df['sub_id'] == sub_id)
-                                                              & (self.subscriptions_df['dates'] > month)
-                                                              & (self.subscriptions_df['invalid_status'] == False)
-                                                              ].sort_values(by='dates')
-                    # if there is no next valid status return canceled
-                    if len(next_valid_status) == 0:
-                        return 'canceled'
-
-                # if theres a prev valid status, get the last status
-                # from the sorted list
-                if len(prev_valid_status) > 0:
-                    valid_status = prev_valid_status.iloc[-1, 2]
-
-                # if theres a next valid status, get the first
-                # status from the sorted list
-                elif len(next_valid_status) > 0:
-                    valid_status = next_valid_status.iloc[0, 2]
-
-                return valid_status
-            else:
-                return row['status']
-
-        # replace the invalid status with the last/next valid status or canceled
-        self.subscriptions_df['status'] = self.subscriptions_df.apply(
-            lambda x: get_last_valid_status(x),
-            axis=1)
-
+        # the frame is sorted by sub_id and dates, so the previous/next
+        # valid status of each subscriber is found by filling along the
+        # rows of its group
+        sub_ids = self.subscriptions_df['sub_id']
+
+        # blank out the invalid statuses so they can be filled in
+        valid_status = self.subscriptions_df['status'].where(
+            ~self.subscriptions_df['invalid_status'])
+
+        # use the last valid status first, then the next valid status,
+        # and canceled if the subscriber has no valid status at all
+        valid_status = valid_status.groupby(
+            sub_ids, observed=True, sort=False).ffill()
+        valid_status = valid_status.groupby(
+            sub_ids, observed=True, sort=False).bfill()
+        self.subscriptions_df['status'] = valid_status.fillna('canceled')
 
     def calculate_months_since_first_subscription(self):
         """
@@ -138,105 +147,61 @@ class Pipe():
         subscription, for every month. Set to N/A if they have no 
         previous subscription
         """
-        def get_months_since_first_subscription(row):
-            """
-            helper function to fetch number of months since first subscription
-            per subscriber on the monthly grain
-
-            Args:
-                row (pd.Series): a row of the subscription df
-
-            Returns:
-                int: number of months since first subscription
-            """
-            sub_id = row['sub_id']
-            month = row['dates']
-            # get first month with active status before current month
-            first_sub_month = self.subscriptions_df[(self.subscriptions_df['sub_id'] == sub_id)
-                                                    & (self.subscriptions_df['status'] == 'active')
-                                                    & (self.subscriptions_df['dates'] <= month)
-                                                    ]['dates'].min()
-
-            # if there is no previous month with active subscription return None
-            if first_sub_month is pd.NaT:
-                return None
-
-            # convert to period to subtract months then .n to get it as an int
-            months_since_first_subscription = (row['dates'].to_period('M')
-                                               - first_sub_month.to_period('M')).n
-
-            return months_since_first_subscription
-
-        self.subscriptions_df['months_since_first_subscription'] = self.subscriptions_df.apply(
-            lambda x: get_months_since_first_subscription(x), axis=1).astype('Int64')
+        # get each subscriber's first active month in a single grouped
+        # pass, then blank it out for the months before it
+        sub_ids = self.subscriptions_df['sub_id']
+        active_dates = self.subscriptions_df['dates'].where(
+            self.subscriptions_df['status'] == 'active')
+        first_sub_month = active_dates.groupby(
+            sub_ids, observed=True, sort=False).transform('min')
+        first_sub_month = first_sub_month.where(
+            first_sub_month <= self.subscriptions_df['dates'])
+
+        # months without a previous subscription stay N/A
+        self.subscriptions_df['months_since_first_subscription'] = months_between(
+            self.subscriptions_df['dates'], first_sub_month).astype('Int16')
 
     def get_num_active_and_canceled_months(self):
         """
         Get the number of months a subscriber was active and number
         of months a subscriber was canceled up to each month
         """
-        def get_status_counts(row):
-            """
-            Helper function to fetch the number of active months 
-            and number of canceled months for up to the given month 
-
-            Args:
-                row (pd.Series): a row of the subscription df
-
-            Returns:
-                int: number of months since first subscription
-            """
-            sub_id = row['sub_id']
-            month = row['dates']
-
-            counts = self.subscriptions_df[(self.subscriptions_df['sub_id'] == sub_id)
-                                           & (self.subscriptions_df['dates'] <= month)
-                                           # use value_counts to avoid creating
-                                           # two functions to count statuses
-                                           ]['status'].value_counts()
-
-            # use get in case a status is not in the counts
-            canceled_months = counts.get('canceled', 0)
-            active_months = counts.get('active', 0)
-            return active_months, canceled_months
-
-        self.subscriptions_df[['active_months', 'canceled_months']] = self.subscriptions_df.apply(
-            lambda x: get_status_counts(x), axis=1, result_type='expand')
+        # the frame is sorted by sub_id and dates, so a running count
+        # per subscriber gives the number of months up to each month.
+        # Both counts are taken in the same grouped pass
+        sub_ids = self.subscriptions_df['sub_id']
+        status_months = pd.DataFrame({
+            'active_months': self.subscriptions_df['status'] == 'active',
+            'canceled_months': self.subscriptions_df['status'] == 'canceled',
+        }).astype('int16')
+
+        self.subscriptions_df[['active_months', 'canceled_months']] = (
+            status_months.groupby(sub_ids, observed=True, sort=False)
+            .cumsum())
 
     def calculate_months_since_status_change(self):
         """
         Get the number of months since a subscriber did their last 
         status change for each month
         """
-        def get_months_since_status_change(row):
-            """
-            Helper function to calculate number of months since
-            subscriber's last status change. Returns N/A if there
-            was no previous status change 
-
-            Args:
-                row (pd.Series): a row of the subscription df
-
-            Returns:
-                int: number of months since last status change
-            """
-            sub_id = row['sub_id']
-            month = row['dates']
-            status = row['status']
-            last_status_change_date = self.subscriptions_df[(self.subscriptions_df['sub_id'] == sub_id)
-                                                            & (self.subscriptions_df['dates'] < month)
-                                                            & (self.subscriptions_df['status'] != status)
-                                                            ]['dates'].max()
-            # if there is no last status change return 0
-            if last_status_change_date is pd.NaT:
-                return None
-            months_since_status_change = (row['dates'].to_period('M')
-                                          - last_status_change_date.to_period('M')).n
-
-            return months_since_status_change
-
-        self.subscriptions_df['months_since_status_change'] = self.subscriptions_df.apply(
-            lambda x: get_months_since_status_change(x), axis=1).astype('Int64')
+        # the frame is sorted by sub_id and dates, so the status changes
+        # are the rows whose status differs from the previous month
+        sub_ids = self.subscriptions_df['sub_id']
+        prev_months = self.subscriptions_df.groupby(
+            sub_ids, observed=True, sort=False)[['status', 'dates']].shift()
+        prev_status = prev_months['status']
+        status_change = prev_status.notna() & (
+            prev_status != self.subscriptions_df['status'])
+
+        # the last month with a different status is the month before the
+        # change, carry it forward until the next change
+        last_status_change_date = prev_months['dates'].where(status_change)
+        last_status_change_date = last_status_change_date.groupby(
+            sub_ids, observed=True, sort=False).ffill()
+
+        # months without a previous status change stay N/A
+        self.subscriptions_df['months_since_status_change'] = months_between(
+            self.subscriptions_df['dates'], last_status_change_date).astype('Int16')
 
     def get_monthly_bookings(self):
         """
@@ -244,52 +209,32 @@ class Pipe():
         per subcscriber per month
         """
 
-        # first transform the timestamps into months
-        def timestamp_to_month(booking_date):
-            """
-            Helper function to transform a timestamp into a date. 
-            The date is the first day of the month of the timestamp.
-
-            Args:
-                booking_date (str): timestamp of a booking
-
-            Returns:
-                str: the first day of the month when the timestamp occured
-            """
-            # remove time
-            timestamp = booking_date.split(' ')[0]
-            # change to first of month to group by month
-            timestamp = timestamp.split('-')
-            timestamp[2] = '01'
-            timestamp = '-'.join(timestamp)
-            return timestamp
-
-        self.bookings_df['month'] = self.bookings_df['booking_date'].apply(
-            lambda x: timestamp_to_month(x))
-
-        self.bookings_per_month = (self.bookings_df[
-            self.bookings_df['booking_status'] == 'Confirmed']
-            .groupby(['month', 'subscriber_id'])
-            .count()
-            # just get booking_status so we're not left with
-            # extra column
-            ['booking_status']
+        # first truncate the timestamps to the first day of their month
+        months = pd.to_datetime(
+            self.bookings_df['booking_date']).values.astype('datetime64[M]')
+        confirmed = (self.bookings_df['booking_status'] == 'Confirmed').values
+
+        # count only the confirmed bookings, naming the columns to
+        # identify the number of confirmed bookings and make join cleaner
+        self.bookings_per_month = (pd.DataFrame({
+            'sub_id': self.bookings_df['subscriber_id'].values[confirmed],
+            'dates': months[confirmed]})
+            .groupby(['sub_id', 'dates'], sort=False)
+            .size()
+            .rename('confirmed_bookings')
             # flatten the index
             .reset_index())
 
-        # change datatype to datetime
-        self.bookings_per_month['month'] = pd.to_datetime(
-            self.bookings_per_month['month'])
-
-        # rename columns to identify number of confirmed bookings and make join cleaner
-        self.bookings_per_month.columns = [
-            'dates', 'sub_id', 'confirmed_bookings']
-
     def save_to_csv(self):
         """
         Combine the procesed subcriptions data with the processed monthly bookings 
         data, remove unnecessary columns and save to csv in the local directory
         """
+        # give the bookings the same sub_id categories as the subscriptions
+        # so the join compares integer codes instead of the raw ids
+        self.bookings_per_month['sub_id'] = self.bookings_per_month[
+            'sub_id'].astype(self.subscriptions_df['sub_id'].dtype)
+
         # create a new df joining the subscription df with the monthly bookings df
         self.output_df = self.subscriptions_df.merge(self.bookings_per_month,
                                                      on=['sub_id', 'dates'],
@@ -297,13 +242,26 @@ class Pipe():
 
         # replace the null values of confirmed_bookings with 0
         self.output_df['confirmed_bookings'] = self.output_df[
-            'confirmed_bookings'].fillna(0).astype(int)
+            'confirmed_bookings'].fillna(0).astype('int32')
 
         # drop column used for processing
         self.output_df.drop(columns='invalid_status', inplace=True)
 
-        self.output_df.sort_values(by=['sub_id', 'dates']).to_csv(
-            'DE_challenge_results.csv', index=False)
+        # the left join keeps the sub_id and dates order of subscriptions_df,
+        # so the output needs no sort. Write it with the multithreaded
+        # pyarrow csv writer, storing the dates without a time component
+        # to keep the previous output format
+        table = pa.Table.from_pandas(self.output_df, preserve_index=False)
+        table = table.set_column(
+            table.schema.get_field_index('dates'), 'dates',
+            table['dates'].cast(pa.date32()))
+
+        # pyarrow always quotes the header, so write it ourselves
+        with open('DE_challenge_results.csv', 'wb') as output_file:
+            output_file.write(
+                (','.join(table.column_names) + '\n').encode())
+            pa_csv.write_csv(table, output_file, pa_csv.WriteOptions(
+                include_header=False, quoting_style='none'))
 
 
 def main(subscriptions_file, bookings_file):